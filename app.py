@@ -1,9 +1,15 @@
 import streamlit as st
 import requests
-import json
+import ijson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from base64 import b64encode
-import pandas as pd
+import io
 import time
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+from itertools import islice
 
 # -----------------
 # Load credentials from Streamlit secrets
@@ -19,96 +25,182 @@ st.title("🔎 Local Keyword Volume Checker (DataForSEO)")
 st.info("🔑 Using DataForSEO credentials from Streamlit secrets")
 
 # Auth setup
-auth = b64encode(f"{login}:{password}".encode()).decode()
-headers = {
-    "Authorization": f"Basic {auth}",
-    "Content-Type": "application/json"
-}
+def _auth_headers(login, password):
+    """Build the Basic auth headers for a credential pair"""
+    auth = b64encode(f"{login}:{password}".encode()).decode()
+    return {
+        "Authorization": f"Basic {auth}",
+        "Content-Type": "application/json"
+    }
+
+class RateLimitRetry(Retry):
+    """Retry policy that also retries POST, but only on 429 (the request was rejected, not processed)"""
+    
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method == "POST":
+            return status_code == 429 and bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
+# Shared HTTP session so API calls reuse pooled keep-alive connections across reruns
+@st.cache_resource
+def get_session(login, password):
+    """Build a pooled requests Session carrying the auth headers"""
+    session = requests.Session()
+    session.headers.update(_auth_headers(login, password))
+    session.mount("https://", HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=10,
+        max_retries=RateLimitRetry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+    ))
+    return session
+
+SESSION = get_session(login, password)
+
+# -----------------
+# Keyword volume requests
+# -----------------
+MAX_KEYWORDS_PER_TASK = 1000  # DataForSEO per-task keyword limit
+MAX_CONCURRENT_REQUESTS = 10  # Parallel POSTs, one per keyword chunk (live endpoints take one task per POST)
+
+def post_volume_tasks(vol_url, tasks):
+    """POST a batch of search volume tasks to DataForSEO"""
+    return SESSION.post(vol_url, json=tasks)
 
 # -----------------
-# Load ALL locations with session state caching (instead of file caching)
+# Load ALL locations with Streamlit's persistent disk cache
 # -----------------
-CACHE_HOURS = 24  # Refresh cache after 24 hours
+LOCATIONS_TTL_SECONDS = 30 * 86400  # Refetch the location database every 30 days
+NGRAM_SIZE = 3  # Gram length for the location search index
+MIN_SEARCH_LENGTH = NGRAM_SIZE  # Characters typed before the location list is filtered
 
-def fetch_locations_from_api():
-    """Fetch locations from DataForSEO API"""
+# Persisted caches ignore ttl, so expiry is keyed on a time bucket argument instead
+@st.cache_data(persist="disk", max_entries=1, show_spinner=False)
+def fetch_locations_from_api(expiry_bucket):
+    """Fetch locations from DataForSEO API, raising on failure so errors are never cached"""
     loc_url = "https://api.dataforseo.com/v3/app_data/google/locations"
     
-    try:
-        loc_resp = requests.get(loc_url, headers=headers)
+    # Transient 429/5xx responses are retried with backoff by the session adapter
+    with SESSION.get(loc_url, stream=True) as loc_resp:
+        loc_resp.raise_for_status()
         
-        if loc_resp.status_code == 200:
-            loc_data = loc_resp.json()
-            locations = []
+        # Stream-parse results as they arrive instead of buffering the whole payload,
+        # tracking top-level and per-task status so API errors are not mistaken for "no locations"
+        loc_resp.raw.decode_content = True
+        locations = []
+        statuses = [{}]  # Top-level status first, then one entry per task
+        builder = None
+        
+        for prefix, event, value in ijson.parse(loc_resp.raw):
+            if prefix == "tasks.item" and event == "start_map":
+                statuses.append({})
+            elif prefix in ("status_code", "status_message"):
+                statuses[0][prefix] = value
+            elif prefix in ("tasks.item.status_code", "tasks.item.status_message"):
+                statuses[-1][prefix.rsplit(".", 1)[1]] = value
             
-            for task in loc_data.get("tasks", []):
-                for result in task.get("result", []):
+            if prefix == "tasks.item.result.item" and event == "start_map":
+                builder = ijson.ObjectBuilder()
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == "tasks.item.result.item" and event == "end_map":
+                    result = builder.value
+                    builder = None
                     locations.append({
                         "name": result["location_name"],
                         "code": result["location_code"],
                         "display": f"{result['location_name']} (code {result['location_code']})"
                     })
-            
-            return locations
-        else:
-            st.error(f"API Error: {loc_resp.status_code} - {loc_resp.text}")
-            return []
-            
-    except Exception as e:
-        st.error(f"Error fetching locations: {str(e)}")
-        return []
+        
+        for status in statuses:
+            if status.get("status_code") != 20000:
+                raise RuntimeError(f"API Error: {status.get('status_code')} - {status.get('status_message', 'Unknown error')}")
+        
+        if not locations:
+            raise RuntimeError("API returned no locations")
+        
+        return locations
 
-def is_cache_fresh():
-    """Check if the session state cache is fresh"""
-    if 'locations_cache_time' not in st.session_state:
-        return False
-    
-    cache_age_hours = (time.time() - st.session_state.locations_cache_time) / 3600
-    return cache_age_hours < CACHE_HOURS
+@st.cache_resource(max_entries=1)
+def build_location_frame(expiry_bucket):
+    """Build a read-only DataFrame of locations with pre-lowercased names for vectorized search"""
+    location_frame = pd.DataFrame(fetch_locations_from_api(expiry_bucket), columns=["name", "code", "display"])
+    location_frame["name_lower"] = location_frame["name"].str.lower()
+    return location_frame
 
-@st.cache_data(ttl=2592000)  # Cache for 30 days across all users
-def load_all_locations(force_refresh=False):
-    """Load locations with session state caching strategy"""
-    
-    # Check session state cache first (unless forced refresh)
-    if not force_refresh and 'locations_data' in st.session_state and is_cache_fresh():
-        cached_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(st.session_state.locations_cache_time))
-        return st.session_state.locations_data, f"Using cached data from {cached_time}"
-    
-    # Fetch from API
-    locations = fetch_locations_from_api()
+@st.cache_resource(max_entries=1)
+def build_location_index(_location_frame, expiry_bucket):
+    """Build an n-gram inverted index over lowercased names, returned with a plain list of those names"""
+    # Postings are compact int arrays, sorted because positions are appended in enumerate order
+    names = _location_frame["name_lower"].tolist()
+    ngram_index = {}
+    for position, name in enumerate(names):
+        for gram in {name[i:i + NGRAM_SIZE] for i in range(len(name) - NGRAM_SIZE + 1)}:
+            postings = ngram_index.get(gram)
+            if postings is None:
+                postings = ngram_index[gram] = array("i")
+            postings.append(position)
+    return ngram_index, names
+
+def search_locations(ngram_index, names, search_term, limit=50):
+    """Return row positions of up to `limit` names containing search_term (at least NGRAM_SIZE characters)"""
+    # Every match appears in the smallest posting list of the query's grams, so scan it in order
+    # and verify the substring directly, stopping as soon as `limit` matches are found
+    grams = {search_term[i:i + NGRAM_SIZE] for i in range(len(search_term) - NGRAM_SIZE + 1)}
+    smallest = min((ngram_index.get(gram, ()) for gram in grams), key=len)
     
-    if locations:
-        # Store in session state instead of file
-        st.session_state.locations_data = locations
-        st.session_state.locations_cache_time = time.time()
-        
-        return locations, f"Fresh data fetched and cached ({len(locations):,} locations)"
-    else:
-        # Fallback to session state cache even if expired
-        if 'locations_data' in st.session_state:
-            cached_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(st.session_state.locations_cache_time))
-            return st.session_state.locations_data, f"API failed - using stale cache from {cached_time}"
+    return list(islice((p for p in smallest if search_term in names[p]), limit))
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def filter_locations(search_term, expiry_bucket, limit=50):
+    """Return up to `limit` matching locations, or the first `limit` when search_term is empty"""
+    location_frame = build_location_frame(expiry_bucket)
+    if not search_term:
+        return location_frame.head(limit).to_dict("records")
+    ngram_index, names = build_location_index(location_frame, expiry_bucket)
+    positions = search_locations(ngram_index, names, search_term, limit)
+    return location_frame.iloc[positions].to_dict("records")
+
+def refresh_locations_button(expiry_bucket):
+    """Render the refresh control, which clears every location cache and refetches when clicked"""
+    if st.button("🔄 Refresh Location Database"):
+        # Clear the memory and disk caches for locations and everything derived from them
+        fetch_locations_from_api.clear()
+        build_location_frame.clear()
+        build_location_index.clear()
+        filter_locations.clear()
         
-        return [], "Failed to load locations from API and no cache available"
+        with st.spinner("Fetching fresh location data..."):
+            try:
+                fetch_locations_from_api(expiry_bucket)
+            except Exception as e:
+                st.error(f"Error fetching locations: {str(e)}")
+                st.stop()
+        st.success("Location database refreshed!")
+        st.rerun()
 
 # Load all locations with caching
-with st.spinner("Loading locations..."):
-    all_locations, cache_status = load_all_locations()
+expiry_bucket = int(time.time() // LOCATIONS_TTL_SECONDS)
 
-# Show cache status
-if cache_status:
-    if "cached data" in cache_status:
-        st.info(f"💾 {cache_status}")
-    elif "Fresh data" in cache_status:
-        st.success(f"🆕 {cache_status}")
-    else:
-        st.warning(f"⚠️ {cache_status}")
+with st.spinner("Loading locations..."):
+    try:
+        location_frame = build_location_frame(expiry_bucket)
+    except Exception as e:
+        st.error(f"Error fetching locations: {str(e)}")
+        location_frame = None
 
-if not all_locations:
+if location_frame is None:
     st.error("Could not load locations. Please check your API credentials.")
+    refresh_locations_button(expiry_bucket)
     st.stop()
 
+st.info(f"💾 {len(location_frame):,} locations loaded")
+
 # -----------------
 # User Inputs
 # -----------------
@@ -117,19 +209,16 @@ keywords_input = st.text_area("Enter keywords (one per line)")
 # Location search/filter
 location_search = st.text_input("Search for a location (city, state, ZIP, country)...")
 
-# Filter locations based on search
-if location_search and len(location_search.strip()) >= 2:
-    search_term = location_search.strip().lower()
-    filtered_locations = [
-        loc for loc in all_locations 
-        if search_term in loc["name"].lower()
-    ][:50]  # Limit to 50 results for performance
+# Filter locations based on search (cached per search term across reruns and sessions)
+if location_search and len(location_search.strip()) >= MIN_SEARCH_LENGTH:
+    filtered_locations = filter_locations(location_search.strip().lower(), expiry_bucket)  # Limit to 50 results for performance
 else:
-    filtered_locations = all_locations[:50]  # Show first 50 by default
+    filtered_locations = filter_locations("", expiry_bucket)  # Show first 50 by default
 
 # Location selection dropdown
 if filtered_locations:
-    display_options = [loc["display"] for loc in filtered_locations]
+    display_map = {loc["display"]: loc for loc in filtered_locations}
+    display_options = list(display_map)
     
     selected_display = st.selectbox(
         f"Select location ({len(filtered_locations)} matches):",
@@ -139,10 +228,7 @@ if filtered_locations:
     
     if selected_display:
         # Find the selected location
-        selected_location = next(
-            loc for loc in filtered_locations 
-            if loc["display"] == selected_display
-        )
+        selected_location = display_map[selected_display]
         
         selected_location_name = selected_location["name"]
         selected_location_code = selected_location["code"]
@@ -176,66 +262,93 @@ if st.button("Get Search Volumes"):
     # Keyword volume lookup
     vol_url = "https://api.dataforseo.com/v3/keywords_data/google_ads/search_volume/live"
     keywords = [k.strip() for k in keywords_input.split("\n") if k.strip()]
-    vol_payload = [{
-        "keywords": keywords,
-        "language_code": language_code,
-        "location_code": selected_location_code
-    }]
+    
+    # Split keywords into per-task chunks (the API per-task keyword limit)
+    vol_payload = [
+        {
+            "keywords": keywords[i:i + MAX_KEYWORDS_PER_TASK],
+            "language_code": language_code,
+            "location_code": selected_location_code
+        }
+        for i in range(0, len(keywords), MAX_KEYWORDS_PER_TASK)
+    ]
     
     # Debug: Show what we're sending
     if debug_mode:
         st.subheader("🔍 Debug: Request Payload")
-        st.json(vol_payload[0])
+        st.json(vol_payload)
     
     with st.spinner("Getting search volumes..."):
-        vol_resp = requests.post(vol_url, headers=headers, data=json.dumps(vol_payload))
-        
-        if vol_resp.status_code != 200:
-            st.error(f"Volume API Error: {vol_resp.status_code} – {vol_resp.text}")
-            st.stop()
+        # One POST per task, dispatched concurrently
+        with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_REQUESTS, len(vol_payload))) as pool:
+            futures = [pool.submit(post_volume_tasks, vol_url, [task]) for task in vol_payload]
         
-        vol_data = vol_resp.json()
+        # Report failed chunks but keep results from the ones that succeeded (those calls are already billed)
+        vol_data = []
+        for chunk_idx, future in enumerate(futures):
+            try:
+                vol_resp = future.result()
+            except requests.RequestException as e:
+                st.warning(f"Volume request for chunk {chunk_idx + 1} of {len(futures)} failed: {str(e)}")
+                continue
+            
+            if vol_resp.status_code != 200:
+                st.warning(f"Volume API Error for chunk {chunk_idx + 1} of {len(futures)}: {vol_resp.status_code} – {vol_resp.text}")
+                continue
+            
+            vol_data.append(vol_resp.json())
         
-        # Debug: Show raw API response
+        # Debug: Show raw API responses
         if debug_mode:
             st.subheader("🔍 Debug: Raw API Response")
-            st.json(vol_data)
+            for response_data in vol_data:
+                st.json(response_data)
         
-        results = []
+        result_items = []
         
         # More detailed parsing with error checking
-        if "tasks" in vol_data:
-            for task_idx, task in enumerate(vol_data["tasks"]):
+        tasks = [task for response_data in vol_data for task in response_data.get("tasks") or []]
+        for task_idx, task in enumerate(tasks):
+            if debug_mode:
+                st.write(f"Task {task_idx}: Status code = {task.get('status_code')}")
+            
+            if task.get("status_code") == 20000:  # Success code
+                task_items = task.get("result") or []
+                
                 if debug_mode:
-                    st.write(f"Task {task_idx}: Status code = {task.get('status_code')}")
+                    st.write(f"Found {len(task_items)} keyword results")
                 
-                if task.get("status_code") == 20000:  # Success code
-                    result_items = task.get("result", [])
-                    
-                    if debug_mode:
-                        st.write(f"Found {len(result_items)} keyword results")
-                    
-                    for item in result_items:
-                        cpc_value = item.get('cpc', 0)
-                        cpc_formatted = f"${cpc_value:.2f}" if cpc_value else "N/A"
-                        
-                        results.append({
-                            "Keyword": item.get("keyword", "N/A"), 
-                            "Search Volume": item.get("search_volume", 0),
-                            "Competition": item.get("competition", "N/A"),
-                            "CPC": cpc_formatted,
-                            "Location": selected_location_name
-                        })
-                else:
-                    st.warning(f"Task failed with status code: {task.get('status_code')} - {task.get('status_message', 'Unknown error')}")
+                result_items.extend(task_items)
+            else:
+                st.warning(f"Task failed with status code: {task.get('status_code')} - {task.get('status_message', 'Unknown error')}")
         
-        if results:
+        if result_items:
             st.subheader(f"📊 Results for {selected_location_name}")
-            df = pd.DataFrame(results)
+            
+            # Build the results table column-wise rather than row by row
+            # Defaults only apply to missing fields; API nulls ("no data") stay empty
+            result_defaults = {"keyword": "N/A", "search_volume": 0, "competition": "N/A", "cpc": 0}
+            df = pd.json_normalize(result_items)
+            for column, default in result_defaults.items():
+                if column not in df:
+                    df[column] = default
+            df = df.reindex(columns=list(result_defaults))
+            df["search_volume"] = pd.to_numeric(df["search_volume"], errors="coerce").astype("Int64")
+            cpc = pd.to_numeric(df["cpc"], errors="coerce").fillna(0)
+            df["cpc"] = cpc.map("${:.2f}".format).where(cpc > 0, "N/A")
+            df["location"] = selected_location_name
+            df = df.rename(columns={
+                "keyword": "Keyword",
+                "search_volume": "Search Volume",
+                "competition": "Competition",
+                "cpc": "CPC",
+                "location": "Location"
+            })
             st.dataframe(df)
             
-            csv_bytes = df.to_csv(index=False).encode("utf-8")
-            st.download_button("Download CSV", csv_bytes, "keyword_volumes.csv", "text/csv")
+            csv_buffer = io.BytesIO()
+            df.to_csv(csv_buffer, index=False, encoding="utf-8")
+            st.download_button("Download CSV", csv_buffer.getvalue(), "keyword_volumes.csv", "text/csv")
         else:
             st.error("❌ No results returned. Check debug info above to see what went wrong.")
 
@@ -243,15 +356,4 @@ if st.button("Get Search Volumes"):
 # Location refresh at bottom
 # -----------------
 st.markdown("---")
-if st.button("🔄 Refresh Location Database"):
-    st.cache_data.clear()  # Clear streamlit cache
-    # Clear session state cache
-    if 'locations_data' in st.session_state:
-        del st.session_state.locations_data
-    if 'locations_cache_time' in st.session_state:
-        del st.session_state.locations_cache_time
-    
-    with st.spinner("Fetching fresh location data..."):
-        all_locations, cache_status = load_all_locations(force_refresh=True)
-    st.success("Location database refreshed!")
-    st.rerun()
+refresh_locations_button(expiry_bucket)